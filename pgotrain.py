@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+
+# This script exercises every stemming algorithm on the sample data, to
+# generate the profile used by a profile-guided optimisation build (see
+# "python setup.py build_ext --pgo").  If a directory is given on the command
+# line, the Stemmer module is imported from there.
+
+import os
+import sys
+
+if len(sys.argv) > 1:
+    sys.path.insert(0, sys.argv[1])
+
+import Stemmer
+
+here = os.path.dirname(os.path.abspath(__file__))
+datafiles = ('sampledata/englishvoc.txt', 'sampledata/puttydoc.txt',)
+
+words = []
+for datafile in datafiles:
+    with open(os.path.join(here, datafile)) as file:
+        for line in file:
+            words.extend(line.split())
+
+for algorithm in Stemmer.algorithms():
+    # Disable the cache so that every word reaches libstemmer.
+    stemmer = Stemmer.Stemmer(algorithm, 0)
+    stems = stemmer.stemWords(words)
+    print("%s: stemmed %d words" % (algorithm, len(stems)))
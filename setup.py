@@ -1,6 +1,56 @@
 #!/usr/bin/env python
 from setuptools import setup, Command, Extension
+from setuptools.command.build_ext import build_ext
+from setuptools.command.sdist import sdist
+import glob
+import hashlib
+import multiprocessing
+import multiprocessing.pool
 import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import warnings
+
+try:
+    from urllib.request import urlopen
+    from urllib.parse import urlparse
+except ImportError:
+    from urllib2 import urlopen
+    from urlparse import urlparse
+
+try:
+    from functools import cached_property
+except ImportError:
+    class cached_property(object):
+        """ Minimal version of functools.cached_property for Python < 3.8.
+        """
+
+        def __init__(self, func):
+            self.func = func
+            self.__doc__ = func.__doc__
+
+        def __get__(self, instance, owner=None):
+            if instance is None:
+                return self
+            value = instance.__dict__[self.func.__name__] = self.func(instance)
+            return value
+
+try:
+    from setuptools.modified import newer_group
+except ImportError:
+    from distutils.dep_util import newer_group
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    # Without Cython we build from the pregenerated src/Stemmer.c, which is
+    # included in the sdist.
+    cythonize = None
 
 
 long_description = r"""
@@ -37,21 +87,67 @@ class LibrarySourceCode:
     # Directories in libstemmer which contain libstemmer sources (ie, not
     # examples, etc).
     LIBRARY_CORE_DIRS = ('src_c', 'runtime', 'libstemmer', 'include')
+    # Matches a C source file directly inside one of the core directories,
+    # as a whitespace separated entry in the manifest.
+    MANIFEST_SOURCE_RE = re.compile(
+        r'(?<![^\s\\])((?:%s)/[^\s\\/]+\.c)(?![^\s\\])' %
+        '|'.join(LIBRARY_CORE_DIRS))
     DEFAULT_URI = 'https://snowballstem.org/dist/libstemmer_c-%s.tar.gz' % \
         libstemmer_c_version
     DEFAULT_CHECKSUM = \
         'd4eca4485f6d3cb4387626a5f508b9b3489d24737525c23ba58026159497a8bc'
+    # Size of the chunks which the tarball is read in while downloading and
+    # checksumming it.
+    CHUNK_SIZE = 65536
+    # Generated by the build_manifest command and shipped in the sdist, so
+    # that builds from the sdist don't need to parse the manifest.
+    SOURCES_RECORD_PATH = os.path.join('src', '_sources.py')
+    # Used when building libstemmer_c as a single translation unit.
+    AMALGAMATION_PATH = os.path.join('build', 'libstemmer_amalg.c')
+    LOCAL_INCLUDE_RE = re.compile(r'^\s*#\s*include\s+"([^"]+)"')
+    # Definitions at file scope which aren't visible outside their file, and
+    # so may use the same name in several source files.
+    FILE_SCOPE_NAME_RES = (
+        re.compile(r'^static\b[^;={(]*?\b(\w+)\s*[\[(=;]', re.M),
+        re.compile(r'^(?:typedef\s+)?struct\s+(\w+)\s*\{', re.M),
+        re.compile(r'^typedef\b[^;{]*?\b(\w+)\s*;', re.M),
+    )
+    MACRO_DEFINITION_RE = re.compile(r'^\s*#\s*define\s+(\w+)', re.M)
+    STEMMER_SOURCE_RE = re.compile(r'^stem_UTF_8_(\w+)\.c$')
+    # Declarations of the among-table search functions which every stemmer
+    # spends most of its time in.
+    HOT_DECLARATION_RE = re.compile(
+        r'^((?:extern\s+)?int\s+find_among(?:_b)?\s*\([^;{]*\))\s*;', re.M)
+    HOT_MACRO_DEFAULT = (
+        '/* Added by PyStemmer setup.py. */\n'
+        '#ifndef PYSTEMMER_HOT\n'
+        '#define PYSTEMMER_HOT\n'
+        '#endif\n'
+    )
+    # Stemmers for other encodings (ISO_8859_1, KOI8_R, ...); the wrapper
+    # only uses UTF-8.
+    OTHER_ENCODING_SOURCE_RE = re.compile(r'/stem_(?!UTF_8_)\w+\.c$')
+    # Matches the lines of modules_utf8.h which refer to a stemmer: the
+    # include of its header, its entries in the modules table and its entry
+    # in the list of algorithm names.
+    MODULES_HEADER_ENTRY_RE = re.compile(
+        r'stem_UTF_8_(\w+)\.h"|\b(\w+)_UTF_8_create_env\b|^\s*"(\w+)",\s*$')
 
-    def __init__(self, directory='libstemmer_c-%s' % libstemmer_c_version):
+    def __init__(self, directory='libstemmer_c-%s' % libstemmer_c_version,
+                 languages=None):
         """ Constructor.
 
         :param str directory: Path to directory where source code should
             reside.
+        :param list(str) languages: Names of the stemming algorithms to
+            build, or None to build all of them.
         :return void:
         """
         self._directory = directory
+        self._languages = languages
+        self._present = os.path.isdir(directory)
 
-    @property
+    @cached_property
     def manifest_file_path(self):
         """ Produce a path to the manifest within the source code.
 
@@ -59,7 +155,7 @@ class LibrarySourceCode:
         """
         return os.path.join(self._directory, 'mkinc_utf8.mak')
 
-    @property
+    @cached_property
     def include_directories(self):
         """ Return all paths to include during the compilation of extension.
 
@@ -67,69 +163,886 @@ class LibrarySourceCode:
         """
         return [os.path.join(self._directory, 'include')]
 
-    def iter_manifest_lines(self):
-        """ Open the manifest file from disk and yield its contents, line by
-        line.
+    def read_manifest(self):
+        """ Find paths to source code files by reading the manifest.
 
-        :yield str:
+        mkinc_utf8.mak should only list the UTF-8 stemmers already, but any
+        stemmers for other encodings are skipped in case it doesn't.
+
+        :return set(str):
         """
         with open(self.manifest_file_path) as file:
-            for line in file:
-                yield line
+            manifest = file.read()
+
+        # Manifest entries are always relative and use forward slashes, and
+        # the regular expression has already checked their directory.
+        return set(
+            self._directory + '/' + path
+            for path in self.MANIFEST_SOURCE_RE.findall(manifest)
+            if not self.OTHER_ENCODING_SOURCE_RE.search(path)
+        )
 
+    def read_sources_record(self):
+        """ Read the paths to source code files from the record written by
+        write_sources_record().
+
+        :return list(str): The paths, or None if there's no record for this
+            source code directory.
+        """
+        if not os.path.exists(self.SOURCES_RECORD_PATH):
+            return None
+        record = {}
+        with open(self.SOURCES_RECORD_PATH) as file:
+            exec(file.read(), record)
+        if record.get('DIRECTORY') != self._directory:
+            return None
+        return record['SOURCES']
+
+    def write_sources_record(self):
+        """ Record the paths to source code files listed in the manifest.
+
+        :return void:
+        """
+        with open(self.SOURCES_RECORD_PATH, 'w') as file:
+            file.write('# Generated by "setup.py build_manifest" - '
+                       'do not edit.\n')
+            file.write('DIRECTORY = %r\n' % self._directory)
+            file.write('SOURCES = [\n')
+            for path in sorted(self.read_manifest()):
+                file.write('    %r,\n' % path)
+            file.write(']\n')
+
+    def stemmer_language(self, path):
+        """ Find which stemming algorithm a source code file implements.
+
+        :param str path: Path to the source code file.
+        :return str: The algorithm name, or None if the file is part of the
+            library core.
+        """
+        match = self.STEMMER_SOURCE_RE.match(os.path.basename(path))
+        return match and match.group(1)
+
+    @cached_property
     def source_code_paths(self):
         """ Find paths to source code files.
 
-        :return set(str):
+        These come from the record in SOURCES_RECORD_PATH if there is one,
+        otherwise from the manifest, and are restricted to the stemmers for
+        the selected languages.  The result is cached, so this is only done
+        once.
+
+        The paths are sorted, so that the order is stable between builds.
+
+        :return list(str):
+        """
+        paths = self.read_sources_record()
+        if paths is None:
+            paths = self.read_manifest()
+        paths = set(paths)
+
+        if self._languages is not None:
+            available = set(self.stemmer_language(path) for path in paths)
+            unknown = set(self._languages) - available
+            if unknown:
+                raise ValueError(
+                    'Unknown stemming algorithms: %s (available: %s)' % (
+                        ', '.join(sorted(unknown)),
+                        ', '.join(sorted(available - set([None])))))
+            paths = set(
+                path for path in paths
+                if self.stemmer_language(path) in
+                (None,) + tuple(self._languages)
+            )
+
+        return sorted(paths)
+
+    @cached_property
+    def modules_header_path(self):
+        """ Produce a path to libstemmer's list of stemming modules.
+
+        :return str:
+        """
+        return os.path.join(self._directory, 'libstemmer', 'modules_utf8.h')
+
+    @cached_property
+    def runtime_header_path(self):
+        """ Produce a path to the header declaring libstemmer's runtime
+        helpers.
+
+        :return str:
         """
-        paths = set()
+        return os.path.join(self._directory, 'runtime', 'header.h')
+
+    def mark_hot_functions(self):
+        """ Tag the declarations of find_among() and find_among_b() with
+        PYSTEMMER_HOT, which the build defines as a "hot" attribute where
+        the compiler supports it (and which is otherwise empty).
 
-        for line in self.iter_manifest_lines():
-            line = line.strip().replace(' \\', '')
-            directory = os.path.split(line)[0]
-            if line.endswith('.c') and directory in self.LIBRARY_CORE_DIRS:
-                paths.add(os.path.join(self._directory, line))
+        If the header is missing or its declarations aren't recognised, it
+        is left alone (with a warning) and nothing is tagged.
+
+        :return void:
+        """
+        try:
+            with open(self.runtime_header_path) as file:
+                header = file.read()
+        except (IOError, OSError):
+            warnings.warn('%s not found; not marking hot functions' %
+                          self.runtime_header_path)
+            return
+        if 'PYSTEMMER_HOT' in header:
+            return
+        header, count = self.HOT_DECLARATION_RE.subn(
+            r'\1 PYSTEMMER_HOT;', header)
+        if not count:
+            warnings.warn('no find_among() declarations found in %s; not '
+                          'marking hot functions' % self.runtime_header_path)
+            return
+        with open(self.runtime_header_path, 'w') as file:
+            file.write(self.HOT_MACRO_DEFAULT + header)
+
+    def write_modules_header(self):
+        """ Make libstemmer's list of stemming modules match the selected
+        languages.
+
+        The header as shipped is kept alongside it (with '.orig' appended), so
+        that it can be restored when building all languages again.
+
+        :return void:
+        """
+        original_path = self.modules_header_path + '.orig'
+        if not os.path.exists(original_path):
+            if self._languages is None:
+                return
+            shutil.copyfile(self.modules_header_path, original_path)
 
-        return paths
+        with open(original_path) as file:
+            lines = file.readlines()
+        if self._languages is not None:
+            lines = [line for line in lines
+                     if self.keep_modules_header_line(line)]
+        header = ''.join(lines)
+
+        with open(self.modules_header_path) as file:
+            if file.read() == header:
+                return
+        with open(self.modules_header_path, 'w') as file:
+            file.write(header)
+
+    def keep_modules_header_line(self, line):
+        """ Should a line of modules_utf8.h be kept for the selected
+        languages?
+
+        :param str line: The line.
+        :return bool:
+        """
+        match = self.MODULES_HEADER_ENTRY_RE.search(line)
+        if match is None:
+            return True
+        language = next(group for group in match.groups() if group)
+        return language in self._languages
+
+    def inline_includes(self, path, seen):
+        """ Read a source file, replacing includes of local headers with the
+        contents of the header the first time each header is seen, and
+        dropping them after that.
+
+        :param str path: Path to the source file.
+        :param set(str) seen: Paths to headers which have already been
+            inlined; updated with any headers inlined now.
+        :return str:
+        """
+        lines = ['#line 1 "%s"\n' % path.replace(os.sep, '/')]
+        with open(path) as file:
+            for line_number, line in enumerate(file, 1):
+                match = self.LOCAL_INCLUDE_RE.match(line)
+                if match is None:
+                    lines.append(line)
+                    continue
+                candidates = [os.path.join(os.path.dirname(path),
+                                           match.group(1))]
+                candidates += [os.path.join(directory, match.group(1))
+                               for directory in self.include_directories]
+                header = next((os.path.normpath(candidate)
+                               for candidate in candidates
+                               if os.path.exists(candidate)), None)
+                if header is None:
+                    lines.append(line)
+                    continue
+                if header not in seen:
+                    seen.add(header)
+                    lines.append(self.inline_includes(header, seen))
+                lines.append('#line %d "%s"\n' %
+                             (line_number + 1, path.replace(os.sep, '/')))
+        return ''.join(lines)
+
+    def write_amalgamation(self, path=None):
+        """ Write all of the library source code into a single C file, so
+        that the compiler can inline across it without needing link-time
+        optimisation.
+
+        The generated stemmers reuse the same names for their static tables
+        and functions, so any file scope name which is defined in more than
+        one source file is renamed with a suffix for its file, and macros
+        defined in each source file are undefined after it.
+
+        :param str path: Where to write the file; defaults to
+            AMALGAMATION_PATH.
+        :return str: The path written to.
+        """
+        path = path or self.AMALGAMATION_PATH
+        sources = sorted(self.source_code_paths)
+        bodies = {}
+        definitions = {}
+        for source in sources:
+            with open(source) as file:
+                bodies[source] = file.read()
+            definitions[source] = set()
+            for name_re in self.FILE_SCOPE_NAME_RES:
+                definitions[source].update(name_re.findall(bodies[source]))
+
+        counts = {}
+        for names in definitions.values():
+            for name in names:
+                counts[name] = counts.get(name, 0) + 1
+
+        seen = set()
+        parts = ['/* Generated by setup.py from libstemmer_c - '
+                 'do not edit. */\n']
+        for source in sources:
+            suffix = os.path.splitext(os.path.basename(source))[0]
+            text = self.inline_includes(source, seen)
+            for name in sorted(definitions[source]):
+                if counts[name] > 1:
+                    text = re.sub(r'\b%s\b' % name,
+                                  '%s__%s' % (name, suffix), text)
+            parts.append(text)
+            parts.append('\n')
+            for macro in sorted(
+                    set(self.MACRO_DEFINITION_RE.findall(bodies[source]))):
+                parts.append('#undef %s\n' % macro)
+        amalgamation = ''.join(parts)
+
+        # Leave an unchanged file alone, so that it doesn't force a rebuild.
+        if os.path.exists(path):
+            with open(path) as file:
+                if file.read() == amalgamation:
+                    return path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as file:
+            file.write(amalgamation)
+        return path
 
     def is_present_on_disk(self):
         """ Is the source code present on disk?
 
+        This is checked once, when this object is created, and updated by
+        download().
+
         :return bool:
         """
-        return os.path.exists(self._directory)
+        return self._present
+
+    def copy_and_hash(self, source, destination=None):
+        """ Read a file in chunks, calculating its SHA256 hash and optionally
+        copying it.
+
+        :param file source: File object to read from.
+        :param file destination: File object to copy to, or None.
+        :return str: Hex digest of the SHA256 hash of the contents.
+        """
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: source.read(self.CHUNK_SIZE), b''):
+            digest.update(chunk)
+            if destination is not None:
+                destination.write(chunk)
+        return digest.hexdigest()
 
     def download(self, url=None, checksum=None):
         """ Download and extract the source code from the web.
 
+        If the tarball is already present in the current directory, it's used
+        instead of downloading it again.  A freshly downloaded tarball is
+        streamed to disk and only kept if its checksum is correct.
+
         :param str url: Url to the zipped source code.
         :param str checksum: Sha256 hash of the archive.
         :return void:
         """
-        from tarballfetcher import download_and_extract_tarball
-        download_and_extract_tarball(
-            url or self.DEFAULT_URI,
-            expected_sha256=checksum or self.DEFAULT_CHECKSUM)
+        url = url or self.DEFAULT_URI
+        checksum = checksum or self.DEFAULT_CHECKSUM
+        tarball_path = os.path.basename(urlparse(url).path)
+
+        if os.path.exists(tarball_path):
+            with open(tarball_path, 'rb') as tarball:
+                actual_checksum = self.copy_and_hash(tarball)
+        else:
+            sys.stdout.write('Downloading %s... ' % url)
+            sys.stdout.flush()
+            partial_path = tarball_path + '.part'
+            response = urlopen(url)
+            try:
+                with open(partial_path, 'wb') as tarball:
+                    actual_checksum = self.copy_and_hash(response, tarball)
+            finally:
+                response.close()
+            if actual_checksum == checksum:
+                os.rename(partial_path, tarball_path)
+            else:
+                os.remove(partial_path)
+            sys.stdout.write('DONE\n')
 
+        sys.stdout.write('Checking that SHA256 of %s is %s... ' %
+                         (tarball_path, checksum))
+        sys.stdout.write('SHA256 is %s. ' % actual_checksum)
+        if actual_checksum != checksum:
+            sys.stdout.write('Incorrect SHA256!\n')
+            sys.exit(1)
+        sys.stdout.write('OK\n')
 
-LIBRARY_SOURCE_CODE = LibrarySourceCode()
+        sys.stdout.write('Extracting %s... ' % tarball_path)
+        sys.stdout.flush()
+        with tarfile.open(tarball_path, 'r:gz') as tarball:
+            if hasattr(tarfile, 'data_filter'):
+                tarball.extractall('.', filter='data')
+            else:
+                tarball.extractall('.')
+        sys.stdout.write('DONE\n')
+        self._present = os.path.isdir(self._directory)
 
-SYSTEM_LIBSTEMMER = os.environ.get('PYSTEMMER_SYSTEM_LIBSTEMMER', False)
-if SYSTEM_LIBSTEMMER:
+
+def find_system_libstemmer(min_version=libstemmer_c_version):
+    """ Look for a system install of libstemmer_c using pkg-config.
+
+    :param str min_version: Oldest version of libstemmer_c to accept.
+    :return dict: Keyword arguments for building the extension against it,
+        or None if there isn't a new enough version installed.
+    """
+    for package in ('libstemmer', 'libstemmer0'):
+        try:
+            subprocess.check_call(
+                ['pkg-config', '--atleast-version=%s' % min_version, package])
+            flags = subprocess.check_output(
+                ['pkg-config', '--cflags-only-I', '--libs', package])
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        settings = {'include_dirs': [], 'library_dirs': [], 'libraries': []}
+        for flag in flags.decode().split():
+            if flag.startswith('-I'):
+                settings['include_dirs'].append(flag[2:])
+            elif flag.startswith('-L'):
+                settings['library_dirs'].append(flag[2:])
+            elif flag.startswith('-l'):
+                settings['libraries'].append(flag[2:])
+        return settings
+    return None
+
+
+LANGUAGES = [
+    language.strip()
+    for language in os.environ.get('PYSTEMMER_LANGUAGES', '').split(',')
+    if language.strip()
+]
+LIBRARY_SOURCE_CODE = LibrarySourceCode(languages=LANGUAGES or None)
+
+NATIVE_OPTIMISATION = os.environ.get('PYSTEMMER_NATIVE', False)
+PGO = os.environ.get('PYSTEMMER_PGO', False)
+AMALGAMATION = os.environ.get('PYSTEMMER_AMALGAMATION', False)
+
+# Options which only apply to a private build of libstemmer_c.
+BUNDLED_ONLY_OPTIONS = [
+    name for name in ('PYSTEMMER_LANGUAGES', 'PYSTEMMER_AMALGAMATION')
+    if os.environ.get(name)
+]
+
+# PYSTEMMER_SYSTEM_LIBSTEMMER set to 0 forces a private build of libstemmer_c
+# and any other non-empty value forces use of the system libstemmer_c.  By
+# default, a system install is used if pkg-config finds one at least as new
+# as the version we would otherwise build, unless options which only apply to
+# a private build are set.
+SYSTEM_LIBSTEMMER_SETTING = os.environ.get('PYSTEMMER_SYSTEM_LIBSTEMMER', '')
+if SYSTEM_LIBSTEMMER_SETTING == '0':
+    SYSTEM_LIBSTEMMER = None
+elif SYSTEM_LIBSTEMMER_SETTING:
+    SYSTEM_LIBSTEMMER = find_system_libstemmer() or {'libraries': ['stemmer']}
+    if BUNDLED_ONLY_OPTIONS:
+        warnings.warn(
+            '%s ignored: using the system libstemmer_c because '
+            'PYSTEMMER_SYSTEM_LIBSTEMMER is set' %
+            ' and '.join(BUNDLED_ONLY_OPTIONS))
+elif BUNDLED_ONLY_OPTIONS:
+    SYSTEM_LIBSTEMMER = None
+else:
+    SYSTEM_LIBSTEMMER = find_system_libstemmer()
+
+WRAPPER_PYX = 'src/Stemmer.pyx'
+WRAPPER_C = 'src/Stemmer.c'
+# An sdist (which has PKG-INFO) ships a src/Stemmer.c generated from its
+# src/Stemmer.pyx.  In a git checkout, src/Stemmer.c is left behind by the
+# last build, so it is only up to date if it is newer than the .pyx.
+WRAPPER_C_IS_CURRENT = os.path.exists(WRAPPER_C) and (
+    os.path.exists('PKG-INFO') or
+    os.path.getmtime(WRAPPER_C) >= os.path.getmtime(WRAPPER_PYX)
+)
+if cythonize is None and WRAPPER_C_IS_CURRENT:
+    WRAPPER_SOURCE = WRAPPER_C
+else:
+    WRAPPER_SOURCE = WRAPPER_PYX
+
+SETUP_REQUIRES = ['setuptools>=18.0']
+if not WRAPPER_C_IS_CURRENT:
+    SETUP_REQUIRES.append('Cython>=3.0')
+
+if SYSTEM_LIBSTEMMER is not None:
     C_EXTENSION = Extension(
         'Stemmer',
-        ['src/Stemmer.pyx'],
-        libraries=['stemmer'],
+        [WRAPPER_SOURCE],
+        **SYSTEM_LIBSTEMMER
     )
 else:
     if not LIBRARY_SOURCE_CODE.is_present_on_disk():
         LIBRARY_SOURCE_CODE.download()
+    LIBRARY_SOURCE_CODE.write_modules_header()
+    LIBRARY_SOURCE_CODE.mark_hot_functions()
+    if AMALGAMATION:
+        library_sources = [LIBRARY_SOURCE_CODE.write_amalgamation()]
+    else:
+        library_sources = LIBRARY_SOURCE_CODE.source_code_paths
     C_EXTENSION = Extension(
         'Stemmer',
-        ['src/Stemmer.pyx'] + list(LIBRARY_SOURCE_CODE.source_code_paths()),
-        include_dirs=LIBRARY_SOURCE_CODE.include_directories
+        [WRAPPER_SOURCE] + library_sources,
+        include_dirs=list(LIBRARY_SOURCE_CODE.include_directories),
+        # Both headers are rewritten by this script, so rebuild when they
+        # change.
+        depends=[LIBRARY_SOURCE_CODE.modules_header_path,
+                 LIBRARY_SOURCE_CODE.runtime_header_path]
     )
 
+# The wrapper just marshals words in and out of libstemmer, so the checks
+# Cython generates by default are pure overhead on every call.
+CYTHON_DIRECTIVES = {
+    'language_level': '3',
+    'boundscheck': False,
+    'wraparound': False,
+    'initializedcheck': False,
+    'cdivision': True,
+    'nonecheck': False,
+    'binding': False,
+    'embedsignature': False,
+}
+EXTENSIONS = [C_EXTENSION]
+if cythonize is not None:
+    EXTENSIONS = cythonize(EXTENSIONS, compiler_directives=CYTHON_DIRECTIVES)
+
+
+def compiler_accepts_flags(compiler, compile_args, link_args=()):
+    """ Check whether a compiler accepts the given flags, by building a
+    trivial program with them.
+
+    :param CCompiler compiler: The compiler to check.
+    :param list(str) compile_args: Flags to pass when compiling.
+    :param list(str) link_args: Flags to pass when linking.
+    :return bool:
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, 'flagcheck.c')
+        with open(source, 'w') as file:
+            file.write('int main(void) { return 0; }\n')
+        try:
+            objects = compiler.compile(
+                [source], output_dir=tmpdir,
+                extra_postargs=list(compile_args) + ['-Werror'])
+            compiler.link_executable(
+                objects, 'flagcheck', output_dir=tmpdir,
+                extra_postargs=list(compile_args) + list(link_args))
+        except Exception:
+            return False
+        return True
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def compile_in_parallel(compiler, jobs):
+    """ Make a (non-MSVC) compiler compile the sources of each extension in
+    parallel.
+
+    distutils only builds separate extensions in parallel, but we have a
+    single extension made from many independent source files.  The largest
+    files are started first, so that they don't hold up the end of the build.
+
+    :param CCompiler compiler: The compiler to modify.
+    :param int jobs: Number of source files to compile at once.
+    :return void:
+    """
+    def compile(sources, output_dir=None, macros=None, include_dirs=None,
+                debug=0, extra_preargs=None, extra_postargs=None,
+                depends=None):
+        macros, objects, extra_postargs, pp_opts, build = \
+            compiler._setup_compile(output_dir, macros, include_dirs,
+                                    sources, depends, extra_postargs)
+        cc_args = compiler._get_cc_args(pp_opts, debug, extra_preargs)
+
+        def compile_object(obj):
+            src, ext = build[obj]
+            compiler._compile(obj, src, ext, cc_args, extra_postargs, pp_opts)
+
+        # distutils decides whether to rebuild per extension, not per object,
+        # so every object is compiled here.
+        pending = sorted(objects,
+                         key=lambda obj: -os.path.getsize(build[obj][0]))
+        pool = multiprocessing.pool.ThreadPool(jobs)
+        try:
+            pool.map(compile_object, pending)
+        finally:
+            pool.close()
+        return objects
+
+    compiler.compile = compile
+
+
+def compiler_is_clang(compiler):
+    """ Check whether a (non-MSVC) compiler is Clang.
+
+    :param CCompiler compiler: The compiler to check.
+    :return bool:
+    """
+    try:
+        output = subprocess.check_output(
+            [compiler.compiler[0], '--version'], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return b'clang' in output.lower()
+
+
+class BuildExtCommand(build_ext):
+    """ Build the extension with optimisation flags suited to the compiler.
+
+    Stemming is dominated by many calls into small libstemmer helpers, so
+    building at a high optimisation level with link-time optimisation lets the
+    compiler inline across the runtime and the generated stemmers.  Only the
+    module init function is exported from the extension.  Setting
+    environment variable PYSTEMMER_NATIVE to a non-empty value additionally
+    tunes the build for the CPU of the build machine (the result may not run
+    on other machines).
+
+    With --pgo (or environment variable PYSTEMMER_PGO set to a non-empty
+    value) the extension is built with profile-guided optimisation on GCC
+    and Clang: it is first built instrumented, then pgotrain.py is run to
+    stem some sample text with every algorithm, and finally the extension is
+    rebuilt using the collected profile.
+
+    Unless told otherwise with --parallel, source files are compiled in
+    parallel using one job per CPU.
+    """
+
+    user_options = build_ext.user_options + [
+        ('pgo', None, 'build with profile-guided optimisation'),
+    ]
+    boolean_options = build_ext.boolean_options + ['pgo']
+
+    MSVC_COMPILE_ARGS = ['/O2', '/GL']
+    MSVC_LINK_ARGS = ['/LTCG']
+    OPTIMISE_COMPILE_ARGS = [
+        '-O3',
+        '-fno-semantic-interposition',
+        '-funroll-loops',
+    ]
+    HOT_ARGS = ['-DPYSTEMMER_HOT=__attribute__((hot))']
+    VISIBILITY_ARGS = ['-fvisibility=hidden']
+    # Before Python 3.9, PyMODINIT_FUNC doesn't give the module init function
+    # default visibility, so we have to.
+    EXPORT_MODULE_INIT_ARGS = [
+        '-DPyMODINIT_FUNC=__attribute__((visibility("default"))) PyObject*',
+    ]
+    # Bind calls within the extension directly rather than through the PLT,
+    # and let the linker drop code and data which nothing refers to.
+    LINUX_COMPILE_ARGS = [
+        '-fno-plt',
+        '-ffunction-sections',
+        '-fdata-sections',
+    ]
+    LINUX_LINK_ARGS = [
+        '-Wl,-Bsymbolic-functions',
+        '-Wl,-z,now',
+        '-Wl,--gc-sections',
+        '-Wl,--as-needed',
+    ]
+    DARWIN_LINK_ARGS = ['-Wl,-dead_strip']
+    LTO_ARGS = (['-flto=auto'], ['-flto'])
+    NATIVE_ARGS = ['-march=native', '-mtune=native']
+    PGO_TRAINING_SCRIPT = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'pgotrain.py')
+
+    def initialize_options(self):
+        build_ext.initialize_options(self)
+        self.pgo = None
+
+    def finalize_options(self):
+        build_ext.finalize_options(self)
+        if self.pgo is None:
+            self.pgo = bool(PGO)
+        if self.parallel is None:
+            self.parallel = multiprocessing.cpu_count()
+
+    def optimisation_flags(self):
+        """ Work out which optimisation flags to use with our compiler.
+
+        :return tuple(list(str), list(str)): Extra compile and link args.
+        """
+        if self.compiler.compiler_type == 'msvc':
+            return list(self.MSVC_COMPILE_ARGS), list(self.MSVC_LINK_ARGS)
+
+        compile_args = [
+            flag for flag in self.OPTIMISE_COMPILE_ARGS
+            if compiler_accepts_flags(self.compiler, [flag])
+        ]
+        compile_args += self.HOT_ARGS
+        link_args = []
+        if sys.platform.startswith('linux'):
+            compile_args += [
+                flag for flag in self.LINUX_COMPILE_ARGS
+                if compiler_accepts_flags(self.compiler, [flag])
+            ]
+            link_args += [
+                flag for flag in self.LINUX_LINK_ARGS
+                if compiler_accepts_flags(self.compiler, [], [flag])
+            ]
+        elif sys.platform == 'darwin':
+            link_args += [
+                flag for flag in self.DARWIN_LINK_ARGS
+                if compiler_accepts_flags(self.compiler, [], [flag])
+            ]
+        for lto_args in self.LTO_ARGS:
+            if compiler_accepts_flags(self.compiler, lto_args, lto_args):
+                compile_args += lto_args
+                link_args += lto_args
+                break
+        if NATIVE_OPTIMISATION and \
+                compiler_accepts_flags(self.compiler, self.NATIVE_ARGS):
+            compile_args += self.NATIVE_ARGS
+        compile_args += self.visibility_flags()
+        return compile_args, link_args
+
+    def visibility_flags(self):
+        """ Work out the flags to hide every symbol except the module init
+        function, keeping libstemmer's symbols out of the dynamic symbol
+        table.
+
+        :return list(str): Extra compile args.
+        """
+        if platform.python_implementation() != 'CPython':
+            # We can't rely on how other implementations define
+            # PyMODINIT_FUNC, so leave symbol visibility alone.
+            return []
+        if not compiler_accepts_flags(self.compiler, self.VISIBILITY_ARGS):
+            return []
+        if sys.version_info < (3, 9):
+            return self.VISIBILITY_ARGS + self.EXPORT_MODULE_INIT_ARGS
+        return list(self.VISIBILITY_ARGS)
+
+    def profiling_commands(self, profile_dir):
+        """ Work out how to do a profile-guided optimisation build.
+
+        :param str profile_dir: Directory to hold the profile data.
+        :return tuple(list(str), list(str), list(str)): Flags for the
+            instrumented build, flags for the optimised build and the command
+            to run in between to prepare the profile data (empty if there is
+            nothing to run).  None if PGO isn't supported by our compiler.
+        """
+        if self.compiler.compiler_type == 'msvc':
+            return None
+        if not compiler_is_clang(self.compiler):
+            return (
+                ['-fprofile-generate=%s' % profile_dir],
+                ['-fprofile-use=%s' % profile_dir, '-fprofile-correction'],
+                [],
+            )
+
+        profdata = shutil.which('llvm-profdata')
+        if profdata:
+            merge = [profdata]
+        elif sys.platform == 'darwin':
+            merge = ['xcrun', 'llvm-profdata']
+        else:
+            return None
+        merged = os.path.join(profile_dir, 'pystemmer.profdata')
+        return (
+            ['-fprofile-instr-generate=%s' %
+             os.path.join(profile_dir, 'pystemmer-%p.profraw')],
+            ['-fprofile-instr-use=%s' % merged],
+            merge + ['merge', '-output=%s' % merged],
+        )
+
+    def run_pgo_training(self):
+        """ Run the training script against the instrumented extension.
+
+        :return void:
+        """
+        module_dir = os.path.dirname(
+            os.path.abspath(self.get_ext_fullpath('Stemmer')))
+        self.spawn([sys.executable, self.PGO_TRAINING_SCRIPT, module_dir])
+
+    def build_extensions_with_flags(self, compile_args, link_args):
+        """ Build the extensions with some extra compile and link args.
+
+        :param list(str) compile_args: Extra flags to compile with.
+        :param list(str) link_args: Extra flags to link with.
+        :return void:
+        """
+        original_args = [
+            (extension.extra_compile_args, extension.extra_link_args)
+            for extension in self.extensions
+        ]
+        for extension in self.extensions:
+            extension.extra_compile_args = \
+                list(extension.extra_compile_args or []) + compile_args
+            extension.extra_link_args = \
+                list(extension.extra_link_args or []) + link_args
+        try:
+            build_ext.build_extensions(self)
+        finally:
+            for extension, (extra_compile_args, extra_link_args) in \
+                    zip(self.extensions, original_args):
+                extension.extra_compile_args = extra_compile_args
+                extension.extra_link_args = extra_link_args
+
+    def build_extensions_with_pgo(self, compile_args, link_args):
+        """ Do a profile-guided optimisation build of the extensions.
+
+        :param list(str) compile_args: Extra flags to compile with.
+        :param list(str) link_args: Extra flags to link with.
+        :return void:
+        """
+        profile_dir = os.path.abspath(os.path.join(self.build_temp, 'pgo'))
+        commands = self.profiling_commands(profile_dir)
+        if commands is None:
+            self.warn('profile-guided optimisation is not supported with '
+                      'this compiler; building without it')
+            self.build_extensions_with_flags(compile_args, link_args)
+            return
+        generate_args, use_args, merge_command = commands
+
+        shutil.rmtree(profile_dir, ignore_errors=True)
+        os.makedirs(profile_dir)
+        force = self.force
+        self.force = True
+        try:
+            self.build_extensions_with_flags(
+                compile_args + generate_args, link_args + generate_args)
+            self.run_pgo_training()
+            if merge_command:
+                self.spawn(merge_command + glob.glob(
+                    os.path.join(profile_dir, '*.profraw')))
+            self.build_extensions_with_flags(
+                compile_args + use_args, link_args + use_args)
+        finally:
+            self.force = force
+
+    def extensions_are_up_to_date(self):
+        """ Check whether build_ext would skip building every extension, in
+        which case there's no need to probe the compiler for flags.
+
+        :return bool:
+        """
+        if self.force or self.pgo:
+            return False
+        for extension in self.extensions:
+            depends = list(extension.sources) + list(extension.depends or [])
+            if newer_group(depends, self.get_ext_fullpath(extension.name),
+                           'newer'):
+                return False
+        return True
+
+    def build_extensions(self):
+        if self.extensions_are_up_to_date():
+            build_ext.build_extensions(self)
+            return
+        if self.parallel and self.parallel > 1 and \
+                self.compiler.compiler_type != 'msvc':
+            compile_in_parallel(self.compiler, self.parallel)
+        compile_args, link_args = self.optimisation_flags()
+        if self.pgo:
+            self.build_extensions_with_pgo(compile_args, link_args)
+        else:
+            self.build_extensions_with_flags(compile_args, link_args)
+
+
+class PgoCommand(BuildExtCommand):
+    description = 'Build extension with profile-guided optimisation'
+
+    def initialize_options(self):
+        BuildExtCommand.initialize_options(self)
+        self.pgo = True
+
+
+class BuildManifestCommand(Command):
+    description = 'Record the libstemmer_c source files to compile'
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        if not LIBRARY_SOURCE_CODE.is_present_on_disk():
+            LIBRARY_SOURCE_CODE.download()
+        self.announce('writing %s' % LIBRARY_SOURCE_CODE.SOURCES_RECORD_PATH,
+                      level=2)
+        LIBRARY_SOURCE_CODE.write_sources_record()
+
+
+class AmalgamateCommand(Command):
+    description = 'Write libstemmer_c as a single C source file'
+    user_options = [
+        ('output=', 'o', 'file to write (default: %s)' %
+         LibrarySourceCode.AMALGAMATION_PATH),
+    ]
+
+    def initialize_options(self):
+        self.output = None
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        if not LIBRARY_SOURCE_CODE.is_present_on_disk():
+            LIBRARY_SOURCE_CODE.download()
+        path = LIBRARY_SOURCE_CODE.write_amalgamation(self.output)
+        self.announce('wrote %s' % path, level=2)
+
+
+class CythonizeCommand(Command):
+    description = 'Generate %s from %s' % (WRAPPER_C, WRAPPER_PYX)
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        if cythonize is None:
+            sys.exit('Cython is needed to generate %s' % WRAPPER_C)
+        cythonize([WRAPPER_PYX], compiler_directives=CYTHON_DIRECTIVES)
+
+
+class SdistCommand(sdist):
+    """ Build a source distribution, including the C code generated from
+    the Cython wrapper (so installing from the sdist doesn't need Cython) and
+    the record of which libstemmer_c source files to compile.
+    """
+
+    def run(self):
+        self.run_command('cythonize')
+        self.run_command('build_manifest')
+        sdist.run(self)
+
 
 class BootstrapCommand(Command):
     description = 'Download libstemmer_c dependency'
@@ -225,9 +1138,16 @@ setup(name='PyStemmer',
           "Topic :: Text Processing :: Indexing",
           "Topic :: Text Processing :: Linguistic",
       ],
-      setup_requires=['Cython>=0.28.5', 'setuptools>=18.0'],
-      ext_modules=[
-          C_EXTENSION
-      ],
-      cmdclass={'bootstrap': BootstrapCommand}
+      setup_requires=SETUP_REQUIRES,
+      extras_require={'dev': ['Cython>=3.0']},
+      ext_modules=EXTENSIONS,
+      cmdclass={
+          'amalgamate': AmalgamateCommand,
+          'bootstrap': BootstrapCommand,
+          'build_ext': BuildExtCommand,
+          'build_manifest': BuildManifestCommand,
+          'cythonize': CythonizeCommand,
+          'pgo': PgoCommand,
+          'sdist': SdistCommand,
+      }
       )
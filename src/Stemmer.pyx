@@ -158,18 +158,9 @@ cdef class Stemmer:
                 newcache[word] = cacheditem
         self.cache = newcache
 
-    def stemWord (self, word):
-        """Stem a word.
-
-        This takes a single argument, ``word``, which should either be a UTF-8
-        encoded string, or a unicode object.
-
-        The result is the stemmed form of the word.  If the word supplied
-        was a unicode object, the result will be a unicode object: if the
-        word supplied was a string, the result will be a UTF-8 encoded
-        string.
-
-        """
+    cdef object _stemWord (self, word):
+        # Implementation of stemWord(), which stemWords() calls directly to
+        # avoid a Python method call per word.
         cdef const char * c_word
         was_unicode = 0
         if isinstance(word, unicode):
@@ -200,6 +191,20 @@ cdef class Stemmer:
             return result.encode(u'utf-8')
         return result
 
+    def stemWord (self, word):
+        """Stem a word.
+
+        This takes a single argument, ``word``, which should either be a UTF-8
+        encoded string, or a unicode object.
+
+        The result is the stemmed form of the word.  If the word supplied
+        was a unicode object, the result will be a unicode object: if the
+        word supplied was a string, the result will be a UTF-8 encoded
+        string.
+
+        """
+        return self._stemWord(word)
+
     def stemWords (self, words):
         """Stem a list of words.
 
@@ -214,8 +219,15 @@ cdef class Stemmer:
         unicode object: if the word supplied was a string, the stemmed form
         will be a UTF-8 encoded string.
 
+        This is faster than calling ``stemWord`` for each word.  Subclasses
+        which override ``stemWord`` have it called for each word instead.
+
         """
-        result = []
+        cdef list result = []
+        if type(self) is not Stemmer:
+            for word in words:
+                result.append(self.stemWord(word))
+            return result
         for word in words:
-            result.append(self.stemWord(word))
+            result.append(self._stemWord(word))
         return result
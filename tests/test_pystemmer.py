@@ -40,6 +40,22 @@ class PyStemmerEnglishTests(PyStemmerBaseTestCase):
         self.assertEqual(self.stemmer.stemWords(['cycling', u'cyclist']),
                          ['cycl', u'cyclist'])
 
+    def test_stemWords_matches_stemWord(self):
+        words = ['cycling', u'cyclist', b'cycles']
+        for cache_size in (0, 10000):
+            stemmer = self.import_pystemmer().Stemmer('english', cache_size)
+            self.assertEqual(stemmer.stemWords(word for word in words),
+                             [stemmer.stemWord(word) for word in words])
+
+    def test_stemWords_uses_overridden_stemWord(self):
+        class UpperStemmer(self.import_pystemmer().Stemmer):
+            def stemWord(self, word):
+                return super(UpperStemmer, self).stemWord(word).upper()
+
+        stemmer = UpperStemmer('english')
+        self.assertEqual(stemmer.stemWords(['cycling', 'cyclist']),
+                         ['CYCL', 'CYCLIST'])
+
     def get_voc_words_file(self):
         import os
         here = os.path.dirname(__file__)